@@ -14,6 +14,28 @@ analyze_pulls() produces the following output files:
     <repo_name>_pulls.csv
     <repo_name>_pulls.json
     <repo_name>_pulls.txt
+
+The pull requests are read through the GitHub GraphQL api when
+authentication is given, as the github-pulls script always does, and
+through the REST api otherwise, i.e. when analyze_pulls() is called with
+auth=None. The page cache, the concurrent downloads of each defect's
+commits and the decoding of pages while they download apply only to those
+unauthenticated REST runs.
+
+On REST runs, the pages downloaded from GitHub are cached, along with
+their ETags, in a dbm database whose files are named
+./.gh_cache_<repo_name>* (the suffixes depend on the dbm implementation),
+so that later REST runs only need to download pages that have changed.
+GraphQL runs, which include every run of the github-pulls script, don't
+use the cache and download everything they check each time.
+
+The defects found are kept in ./<owner_name>_<repo_name>_state.json.gz, so
+that the next run only needs to check the pull requests created since.
+Pull requests that were already checked aren't looked at again, so changes
+made to them later, such as new commits on an open pull request or a
+defect label added afterwards, are missed. Call analyze_pulls() with
+rescan=True, or delete the state file, to check all of the pull requests
+again.
     
 
 Copyright 2015 Grip QA
@@ -41,27 +63,121 @@ __version__ = "0.0.1"
 
 import sys
 import os
-import requests
+import httpx
 import argparse
 import configparser
+import datetime
 import re
 import json
 import csv
+import itertools
+import shelve
+import hashlib
+import gzip
+import threading
+import importlib.util
+import functools
 
 from enum import Enum, unique
+from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+
+# orjson is optional, it's only used to speed up writing the JSON output
+try:
+    import orjson
+except ImportError:
+    orjson = None
+# ijson is optional, when it's available pages of issues are decoded while
+# they are still downloading
+try:
+    import ijson
+except ImportError:
+    ijson = None
+# HTTP/2 needs httpx's optional h2 dependency, without it we use HTTP/1.1
+HTTP2 = importlib.util.find_spec("h2") is not None
 
 VERBOSE = True
 
 REPO_BASE = "https://api.github.com/repos/"
+GQL_URL = "https://api.github.com/graphql"
 PARAMS = [("state", "all"),("per_page", "100")]
 ERR_LABEL = "ERROR: "
 NOTE_LABEL = "NOTE: "
 ERR_INDENT = ' '*len(ERR_LABEL)
 NOTE_INDENT = ' '*len(NOTE_LABEL)
 EXITING_STR = ''.join([ERR_INDENT, "Exiting...\n"])
+# Maximum number of pull requests whose commits are downloaded concurrently
+MAX_WORKERS = 10
+# Responses with these status codes are retried, up to MAX_RETRIES times,
+# waiting RETRY_BACKOFF seconds, doubled for each attempt, in between
+RETRY_STATUSES = frozenset({502, 503, 504})
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
 # Set of labels that designate a pull request as representing a bug.
-DEFECTS = {"bug", "defect", "kind/bug"}
-#DEFECTS = {"bug", "defect", "kind/bug", "enhancement"}
+DEFECTS = frozenset({"bug", "defect", "kind/bug"})
+#DEFECTS = frozenset({"bug", "defect", "kind/bug", "enhancement"})
+# GraphQL query for a page of a repo's pull requests, newest first,
+# returning only the fields that we actually use.
+PULLS_QUERY = """
+query($owner: String!, $name: String!, $after: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(first: 100, after: $after,
+                 orderBy: {field: CREATED_AT, direction: DESC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number
+        labels(first: 100) { nodes { name } }
+        commits(first: 100) {
+          pageInfo { hasNextPage endCursor }
+          nodes { commit { oid } }
+        }
+      }
+    }
+  }
+}
+"""
+# GraphQL query for the next page of a single pull request's commits, for
+# pull requests with more commits than fit in PULLS_QUERY's page
+PULL_COMMITS_QUERY = """
+query($owner: String!, $name: String!, $number: Int!, $after: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      commits(first: 100, after: $after) {
+        pageInfo { hasNextPage endCursor }
+        nodes { commit { oid } }
+      }
+    }
+  }
+}
+"""
+# Headers sent with every request to the GitHub REST api
+HEADERS = {"Accept":"application/vnd.github+json"
+          ,"User-Agent":"github-pulls"
+          }
+
+# Single client shared by all requests and threads, so that the connection
+# to the api host is kept alive and reused, rather than paying for a new
+# TCP/TLS handshake on every page that we fetch. With HTTP/2 all of the
+# concurrent requests are multiplexed over that one connection, otherwise
+# each worker thread gets its own.
+_CLIENT = httpx.Client( headers=HEADERS
+                       ,timeout=30
+                       ,follow_redirects=True
+                       ,transport=httpx.HTTPTransport(
+                           http2=HTTP2
+                          ,retries=MAX_RETRIES
+                          ,limits=httpx.Limits(
+                              max_connections=1 if HTTP2 else MAX_WORKERS)
+                          )
+                      )
+
+# On-disk cache of previously downloaded pages, keyed by url & parameters.
+# Opened by open_cache(), when it is None, no conditional requests are made
+_CACHE = None
+# shelve objects aren't safe to share between threads
+_CACHE_LOCK = threading.Lock()
+# Progress stars written on the current line, see show_progress()
+_STARS = 0
 
 
 @unique
@@ -88,28 +204,151 @@ def get_params():
     return PARAMS
 
 
-def is_defect(pull_req, params, auth):
-    """Checks the given pull request data against our criteria for
-    identifying defects
+def write_status(msg):
+    """Writes a status message to stdout, ending any line of progress stars
+    first, so that the message starts on a line of its own.
     Args:
-        pull_req - dict representing a single pull request
-        params - list of parameter tuples
-        auth - authorization information
+        msg - str containing the message, with its trailing newline
+    """
+    global _STARS
+    if _STARS:
+        sys.stdout.write("\n")
+        _STARS = 0
+    sys.stdout.write(msg)
+
+
+def json_bytes(obj):
+    """Serializes the given object as compact JSON, without any of the
+    optional whitespace. Uses orjson, when it's available.
+    Args:
+        obj - object to serialize
+    Returns:
+        bytes containing the UTF-8 encoded JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def is_defect(issue):
+    """Checks the given issue data against our criteria for identifying
+    defects. The issue listing already carries each issue's labels, so this
+    doesn't need to go back to GitHub.
+    Args:
+        issue - dict representing a single issue/pull request
     Returns:
         True if our analysis indicates that the issue/pull request is
         associated with addressing a defect
     """
-    # Check the corresponding issue
-    issue = get_page(pull_req["issue_url"], params, auth)
-    labels = issue.json().get("labels", [])
-    label_names = []
-    for l in labels:
-        label_names.append(l["name"])
-    isect = DEFECTS.intersection(set(label_names))
-    if isect:
-        return True
-    else:
+    return not DEFECTS.isdisjoint(l["name"] for l in issue.get("labels", ()))
+
+
+class CachedResponse(httpx.Response):
+    """Stands in for the response when GitHub tells us that a page hasn't
+    changed (304) and we return the copy from the cache instead.
+    """
+    def __init__(self, entry):
+        super().__init__(200, headers=entry["headers"],
+                         content=entry["content"])
+
+
+def open_cache(repo):
+    """Opens the on-disk cache of downloaded pages for the given repo.
+    While the cache is open, get_page() sends conditional requests, using
+    the ETag from the previous download of the page.
+    Args:
+        repo - str giving the name of the repo
+    """
+    global _CACHE
+    # No extension, dbm adds whatever suffixes it uses itself
+    _CACHE = shelve.open(''.join(["./.gh_cache_", repo]))
+
+
+def close_cache():
+    """Flushes and closes the on-disk page cache, if it is open.
+    """
+    global _CACHE
+    if _CACHE is not None:
+        _CACHE.close()
+        _CACHE = None
+
+
+def cache_key(url, params):
+    """Builds the key identifying a single page in the cache
+    Args:
+        url - str containing the url of the request
+        params - list of parameter tuples
+    Returns:
+        str with the hex digest identifying the request
+    """
+    return hashlib.sha1((url + str(params)).encode("utf-8")).hexdigest()
+
+
+def store_page(key, etag, headers, content):
+    """Saves a downloaded page in the cache
+    Args:
+        key - str identifying the page, from cache_key()
+        etag - str with the ETag that GitHub returned for the page
+        headers - the page's response headers
+        content - bytes containing the page's body
+    """
+    cached_headers = {}
+    if "link" in headers:
+        cached_headers["link"] = headers["link"]
+    with _CACHE_LOCK:
+        _CACHE[key] = { "etag":etag
+                       ,"content":content
+                       ,"headers":cached_headers
+                      }
+
+
+class BodyReader(object):
+    """File-like wrapper around the body of a streamed response, for
+    decoders that want to read() it. If given a store function, a copy of
+    what is read is passed to it once the body has been read to the end,
+    a body that isn't read all the way through isn't stored.
+    """
+    def __init__(self, chunks, store=None):
+        self._chunks = chunks
+        self._buf = bytearray()
+        self._store = store
+        self._copy = [] if store is not None else None
+
+    def read(self, size=-1):
+        while self._chunks is not None and (size < 0 or
+                                            len(self._buf) < size):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                # End of the body
+                self._chunks = None
+                if self._store is not None:
+                    self._store(b''.join(self._copy))
+            elif chunk:
+                self._buf += chunk
+                if self._copy is not None:
+                    self._copy.append(chunk)
+        if size < 0:
+            size = len(self._buf)
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        return data
+
+
+def retry_wait(response, attempt):
+    """Decides whether a failed request should be retried and, if so, waits
+    before the next attempt.
+    Args:
+        response - the response to the request
+        attempt - int, number of retries made so far
+    Returns:
+        True if the caller should retry the request
+    """
+    if response.status_code not in RETRY_STATUSES or attempt >= MAX_RETRIES:
         return False
+    response.close()
+    sleep(RETRY_BACKOFF * 2**attempt)
+    return True
+
 
 def wait_it_out(msg, total_wait):
     """If our access to the repo's REST api is being rate limited, we might
@@ -124,24 +363,40 @@ def wait_it_out(msg, total_wait):
     """
     total_wait += 15
     wait_incr = 240
-    fstrlst = ["{0}{1}\n      ", "{2}", " minutes remaining..."]
+    fstr_int = "{0}{1}\n      {2} minutes remaining...\n"
+    fstr_flt = "{0}{1}\n      {2:0.2f} minutes remaining...\n"
     while total_wait >= 0:
         if total_wait > 60:
-            mins = total_wait // 60
+            fstr, mins = fstr_int, total_wait // 60
         else:
-            mins = total_wait / 60
-            fstrlst[1] = "{1:0.2f}"
-        fstr = ''.join(fstrlst)+'\n'
-        sys.stdout.write(fstr.format(gh_shared.NOTE_LABEL, msg, mins))
+            fstr, mins = fstr_flt, total_wait / 60
+        sys.stdout.write(fstr.format(NOTE_LABEL, msg, mins))
         sleep(wait_incr if total_wait > wait_incr else total_wait)
         total_wait -= wait_incr
 
-    sys.stdout.write( ''.join([ gh_shared.NOTE_LABEL
-                     ,"Wait completed, continuing execution...\n"
-                     ]))
+    sys.stdout.write(NOTE_LABEL + "Wait completed, continuing execution...\n")
 
 
-def get_page(url, params, auth):
+def wait_for_reset(response):
+    """Waits until the rate limit that the given response ran into has
+    been reset.
+    Args:
+        response - the response that reported our remaining allocation of
+                    requests as 0
+    """
+    reset = int(response.headers["x-ratelimit-reset"])
+    reset_at = datetime.datetime.utcfromtimestamp(reset)
+    now = datetime.datetime.utcnow()
+    wait_time = (reset_at - now).seconds
+    fstr = ("Rate Limit Hit, waiting for reset...\n"
+            "Resets at: {0}\n"
+            "Currently: {1}\n"
+            "Waiting:   {2} minutes\n")
+    write_status(fstr.format(reset_at, now, wait_time // 60))
+    wait_it_out("Rate Limit Hit", wait_time)
+
+
+def get_page(url, params, auth, stream=False):
     """Get a page of issues from the GitHub REST api
     Args:
         url - str containing the url to request
@@ -149,82 +404,172 @@ def get_page(url, params, auth):
                     request
         auth - either a tuple of two strings that will be user/pwd for
                     authentication, or None
+        stream - when True, the body isn't downloaded up front, the caller
+                    reads it from the response's reader member and must
+                    close the response
     Returns:
-        The list of pull requests, if successful.
+        The list of pull requests, if successful. If the page is unchanged
+        since it was cached, the cached copy is returned instead.
         Waits if we are rate limited
         Raises an exception if the status code has some other unsuccessful
         value
     """
-    response = requests.get(url, params=params, auth=auth)
-    if response.headers["x-ratelimit-remaining"] == "0":
-        sys.stdout.write("Rate Limit Hit, waiting for reset...\n")
-        reset = int(response.headers["x-ratelimit-reset"])
-        reset_at = datetime.datetime.utcfromtimestamp(reset)
-        wait_time = (reset_at - datetime.datetime.utcnow()).seconds
-        sys.stdout.write("Resets at: {}\n".format(reset_at))
-        sys.stdout.write("Currently: {}\n".format(datetime.datetime.utcnow()))
-        sys.stdout.write("Waiting:   {} minutes\n".format(wait_time // 60))
-        wait_it_out("Rate Limit Hit", wait_time)
-        return get_page(url, params, auth)
-    elif response.status_code == 200:
-        return response
-    else:
-        raise Exception(response.status_code)
+    entry = None
+    headers = None
+    if _CACHE is not None:
+        key = cache_key(url, params)
+        with _CACHE_LOCK:
+            entry = _CACHE.get(key)
+        if entry is not None:
+            headers = {"If-None-Match":entry["etag"]}
+    attempt = 0
+    while True:
+        # Merge the parameters into the url's own query, the next page urls
+        # that GitHub hands us already carry the page number
+        request = _CLIENT.build_request(
+                    "GET", httpx.URL(url).copy_merge_params(params or []),
+                    headers=headers)
+        response = _CLIENT.send(request, auth=auth, stream=stream)
+        if retry_wait(response, attempt):
+            attempt += 1
+            continue
+        elif response.headers["x-ratelimit-remaining"] == "0":
+            response.close()
+            wait_for_reset(response)
+            continue
+        elif response.status_code == 304 and entry is not None:
+            response.close()
+            return CachedResponse(entry)
+        elif response.status_code == 200:
+            etag = response.headers.get("ETag")
+            store = None
+            if _CACHE is not None and etag is not None:
+                store = functools.partial(store_page, key, etag,
+                                          response.headers)
+            if stream:
+                response.reader = BodyReader(response.iter_bytes(), store)
+            elif store is not None:
+                store(response.content)
+            return response
+        else:
+            response.close()
+            raise Exception(response.status_code)
+
+
+def post_query(query, variables, auth):
+    """Run a query against the GitHub GraphQL api
+    Args:
+        query - str containing the GraphQL query
+        variables - dict of values for the query's variables
+        auth - tuple of two strings that will be user/pwd (or token) for
+                    authentication. GraphQL doesn't allow anonymous access
+    Returns:
+        The "data" member of the query's result, if successful.
+        Waits if we are rate limited
+        Raises an exception if the status code has some other unsuccessful
+        value, or if the query reports errors
+    """
+    attempt = 0
+    while True:
+        response = _CLIENT.post( GQL_URL
+                                ,json={"query":query, "variables":variables}
+                                ,auth=auth
+                               )
+        if retry_wait(response, attempt):
+            attempt += 1
+            continue
+        elif response.headers.get("x-ratelimit-remaining") == "0":
+            wait_for_reset(response)
+            continue
+        elif response.status_code == 200:
+            result = response.json()
+            if result.get("errors"):
+                raise Exception(result["errors"])
+            return result["data"]
+        else:
+            raise Exception(response.status_code)
 
 
-def download_pulls(url, params, auth):
-    """Get all of the pull requests in the repo
+def download_pulls(url, params, auth, since_number=0, newest=None):
+    """Get all of the issues/pull requests in the repo
 
     Args:
         url - str specifying the URL of the GitHub repo
         params - list of parameter tuples
         auth - authorization information
-    Returns:
-        list containing all pull request records
+        since_number - only return records numbered above this. The pages
+                    must be sorted newest first, paging stops at the first
+                    record that isn't newer
+        newest - optional dict, its "number" is raised to the highest
+                    record number seen, whether or not the record is
+                    returned
+    Yields:
+        each issue/pull request record
     """
-    pull_reqs = []
     total_recs = 0
+    fstr = "Processing {0} issues/pull requests, for {1} total\n"
     while url is not None:
-        response = get_page(url, params, auth)
-        pull_list = response.json()
-        pull_reqs.extend(pull_list)
-        num_pulls = len(pull_list)
+        response = get_page(url, params, auth, stream=ijson is not None)
+        if ijson is not None and not isinstance(response, CachedResponse):
+            # Decode the records as the page arrives, overlapping the
+            # decoding, and our callers' work, with the download
+            pull_list = ijson.items(response.reader, "item", use_float=True)
+        else:
+            pull_list = response.json()
+        done = False
+        num_pulls = 0
+        try:
+            for p in pull_list:
+                if newest is not None and p["number"] > newest["number"]:
+                    newest["number"] = p["number"]
+                if since_number and p["number"] <= since_number:
+                    done = True
+                    break
+                num_pulls += 1
+                yield p
+        finally:
+            response.close()
         total_recs += num_pulls
-        fstr = "Processing {0} issues/pull requests, for {1} total\n"
-        sys.stdout.write(fstr.format(num_pulls, total_recs))
-        if "link" in response.headers:
-            pages = dict(
-                [(reln[6:-1], ref[ref.index('<')+1:-1]) for ref, reln in
-                 [refs.split(';') for refs in
-                  response.headers['link'].split(',')]])
-            if "last" in pages and "next" in pages:
-                url = pages["next"]
-            else:
-                url = None
+        write_status(fstr.format(num_pulls, total_recs))
+        if done:
+            url = None
+        elif "next" in response.links and "last" in response.links:
+            url = response.links["next"]["url"]
         else:
             url = None
-    return pull_reqs
 
 
-def get_pull_requests(owner, repo, params, auth):
+def get_issues_with_pulls(owner, repo, params, auth, since_number=0,
+                          newest=None):
     """Builds up the URL for the first GET and then retrieves all of
-    the repo's pull requests.
+    the repo's pull requests. GitHub lists pull requests as issues as well,
+    with their labels included, which spares us a request per pull request
+    to look the labels up.
 
     Args:
         owner - str specifying the owner of the repo
         repo - str giving the name of the repo
         params - list of parameter tuples
         auth - authorization information
+        since_number - only return pull requests numbered above this
+        newest - optional dict, its "number" is raised to the highest issue
+                    number seen (see download_pulls())
     Returns:
-        list of pull request dictionary objects
+        iterator over the issue dictionary objects, for the issues that are
+        pull requests
     """
     url = "".join([REPO_BASE
                    ,owner
                    ,"/"
                    ,repo
-                   ,"/pulls"
+                   ,"/issues"
                    ])
-    return download_pulls(url, params, auth)
+    # Newest first, so an incremental run can stop at the last pull request
+    # that it has already seen
+    params = params + [("sort", "created"), ("direction", "desc")]
+    return (i for i in download_pulls(url, params, auth, since_number,
+                                      newest)
+            if "pull_request" in i)
 
 
 def get_commits_by_url(commits_url, params, auth):
@@ -240,10 +585,16 @@ def get_commits_by_url(commits_url, params, auth):
         list of commit SHA-1s that make up the given pull request
     """
     commit_shas = []
-    commits = get_page(commits_url, params, auth).json()
-    for c in commits:
-        commit_shas.append(c["sha"])
-        #print("#{0}- Cmmt: {1}".format(pull_url.split("/")[-2], c["sha"]))
+    url = commits_url
+    while url:
+        response = get_page(url, params, auth)
+        for c in response.json():
+            commit_shas.append(c["sha"])
+            #print("#{0}- Cmmt: {1}".format(pull_url.split("/")[-2], c["sha"]))
+        if "next" in response.links:
+            url = response.links["next"]["url"]
+        else:
+            url = None
 
     return commit_shas
 
@@ -275,96 +626,296 @@ def get_commits_by_pull_num(pull_num, owner, repo, params, auth):
 
 def get_commits_by_pull(pull, params, auth):
     """Extracts the commits that make up the pull represented by the given
-    GitHub pull dictionary.
+    GitHub issue dictionary.
 
     Args:
-        pull - dict containing information about a single pull from the
-                GitHub RESTful interface
+        pull - dict containing information about a single issue, that is
+                a pull request, from the GitHub RESTful interface
         params - list of parameter tuples
         auth - authorization information
     Returns:
         list of commit SHA-1s that make up the given pull request
     """
-    return get_commits_by_url(pull["commits_url"], params, auth)
-    
+    commits_url = pull["pull_request"]["url"] + "/commits"
+    return get_commits_by_url(commits_url, params, auth)
 
 
-def analyze_pulls(owner, repo, params, auth=None):
+def get_commits_graphql(owner, repo, number, commits, auth):
+    """Collects all of a pull request's commits through the GraphQL api,
+    starting from the first page that came back with the pull request and
+    following the cursor for any further pages.
+
+    Args:
+        owner - str specifying the owner of the repo
+        repo - str giving the name of the repo
+        number - int giving the pull request's number
+        commits - dict holding the first page of the pull request's commits
+        auth - authorization information, required
+    Returns:
+        list of commit SHA-1s that make up the given pull request
+    """
+    commit_shas = [c["commit"]["oid"] for c in commits["nodes"]]
+    variables = {"owner":owner, "name":repo, "number":number, "after":None}
+    while commits["pageInfo"]["hasNextPage"]:
+        variables["after"] = commits["pageInfo"]["endCursor"]
+        data = post_query(PULL_COMMITS_QUERY, variables, auth)
+        commits = data["repository"]["pullRequest"]["commits"]
+        commit_shas.extend(c["commit"]["oid"] for c in commits["nodes"])
+
+    return commit_shas
+
+
+def get_defect_commits_graphql(owner, repo, auth, since_number=0,
+                               newest=None):
+    """Retrieves the commits for all of the repo's pull requests that
+    address defects, using the GraphQL api. Each query returns a page of
+    100 pull requests along with their labels and commits, so this takes
+    far fewer, and much smaller, requests than going through the REST api.
+
+    Args:
+        owner - str specifying the owner of the repo
+        repo - str giving the name of the repo
+        auth - authorization information, required
+        since_number - only pull requests numbered above this are checked
+        newest - optional dict, its "number" is raised to the highest pull
+                    request number seen, defect or not
+    Yields:
+        tuple of a pull request number and its list of commit SHA-1s, for
+        each pull request that addresses a defect
+    """
+    total_recs = 0
+    fstr = "Processing {0} pull requests, for {1} total\n"
+    variables = {"owner":owner, "name":repo, "after":None}
+    while True:
+        data = post_query(PULLS_QUERY, variables, auth)
+        pulls = data["repository"]["pullRequests"]
+        num_pulls = len(pulls["nodes"])
+        total_recs += num_pulls
+        write_status(fstr.format(num_pulls, total_recs))
+        for p in pulls["nodes"]:
+            if newest is not None and p["number"] > newest["number"]:
+                newest["number"] = p["number"]
+            # The pull requests come newest first
+            if p["number"] <= since_number:
+                return
+            labels = p["labels"]["nodes"]
+            if DEFECTS.isdisjoint(l["name"] for l in labels):
+                continue
+            yield p["number"], get_commits_graphql(owner, repo, p["number"],
+                                                   p["commits"], auth)
+        if not pulls["pageInfo"]["hasNextPage"]:
+            return
+        variables["after"] = pulls["pageInfo"]["endCursor"]
+
+
+def get_defect_commits(owner, repo, params, auth, since_number=0,
+                       newest=None):
+    """Retrieves the commits for all of the repo's pull requests that
+    address defects, using the REST api. The issues are listed first, then
+    the commits for each defect are downloaded. The repo's page cache is
+    kept open for the duration, only the REST api's pages are cached.
+
+    Args:
+        owner - str specifying the owner of the repo
+        repo - str giving the name of the repo
+        params - list of parameter tuples
+        auth - authorization information
+        since_number - only pull requests numbered above this are checked
+        newest - optional dict, its "number" is raised to the highest pull
+                    request number seen, defect or not
+    Yields:
+        tuple of a pull request number and its list of commit SHA-1s, for
+        each pull request that addresses a defect
+    """
+    open_cache(repo)
+    try:
+        pulls = get_issues_with_pulls(owner, repo, params, auth,
+                                      since_number, newest)
+        # Distill the defects down to the two fields used from here on, the
+        # full issue payloads are released as soon as each one is checked
+        defects = [(p["number"], p["pull_request"]["url"] + "/commits")
+                   for p in pulls if is_defect(p)]
+        # The downloads are network bound, so overlap them across a pool of
+        # threads sharing the client's connections. map() hands the
+        # results back in the original order of the pull requests.
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            results = pool.map(
+                lambda d: get_commits_by_url(d[1], params, auth), defects)
+            for (num, commits_url), commits in zip(defects, results):
+                yield num, commits
+    finally:
+        close_cache()
+
+
+def show_progress(defects):
+    """Passes the defects found through, reporting progress along the way.
+    Shared by the GraphQL and REST paths. The stars share their lines with
+    the paths' other status messages, see write_status().
+    Args:
+        defects - iterator of (pull request number, commit SHA-1s) tuples
+    Yields:
+        the tuples from defects, unchanged
+    """
+    fstr = ("{0}Checking for defects associated with pull requests.\n"
+            "{1}This might take a bit of time...\n")
+    global _STARS
+    write_status(fstr.format(NOTE_LABEL, NOTE_INDENT))
+    progress = 0
+    for d in defects:
+        # One star for every 10 defects, 70 stars to a line
+        if VERBOSE:
+            progress += 1
+            if progress % 10 == 0:
+                sys.stdout.write("*")
+                _STARS += 1
+                if _STARS == 70:
+                    sys.stdout.write("\n")
+                    _STARS = 0
+                sys.stdout.flush()
+
+        yield d
+
+    write_status("")
+
+
+def state_path(owner, repo):
+    """Builds the path of the file holding the results of earlier runs
+    Args:
+        owner - str specifying the owner of the repo
+        repo - str giving the name of the repo
+    Returns:
+        str with the path to the state file
+    """
+    return ''.join(["./", owner, "_", repo, "_state.json.gz"])
+
+
+def load_state(owner, repo):
+    """Loads the results of the previous run against the repo, if any.
+    Args:
+        owner - str specifying the owner of the repo
+        repo - str giving the name of the repo
+    Returns:
+        dict with the highest pull request number checked so far, in
+        "max_pull_number", and the commits of the defects found, by pull
+        request number, in "pull_commits"
+    """
+    try:
+        with gzip.open(state_path(owner, repo), "rb") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {"max_pull_number":0, "pull_commits":{}}
+    # JSON object keys are always strings
+    state["pull_commits"] = {int(num):commits
+                             for num, commits in state["pull_commits"].items()}
+    return state
+
+
+def save_state(owner, repo, max_pull_number, pull_commits):
+    """Saves the results of this run, so that the next run against the
+    repo only needs to check newer pull requests.
+    Args:
+        owner - str specifying the owner of the repo
+        repo - str giving the name of the repo
+        max_pull_number - int, newest pull request number seen
+        pull_commits - dict of commit SHA-1 lists, by pull request number
+    """
+    with gzip.open(state_path(owner, repo), "wb") as f:
+        f.write(json_bytes({ "max_pull_number":max_pull_number
+                            ,"pull_commits":{str(num):commits
+                                             for num, commits
+                                             in pull_commits.items()}
+                           }))
+
+
+def analyze_pulls(owner, repo, params, auth=None, rescan=False):
     """Main processing method for this module.
     Given the repo and auth information, extracts the pull requests and
     analyzes them to determine which ones were assocated with addressing
     defects. For those that were, captures the pull request's SHA-1
     The results are saved to a file.
+    The defects found are also saved to a state file, along with the
+    newest pull request seen, and only pull requests newer than that are
+    checked on the next run. The earlier results are merged into the
+    output files. Pull requests that were already checked aren't looked at
+    again, so later changes to them, e.g. new commits or a defect label
+    added afterwards, are only picked up by a rescan.
 
     Args:
         owner - str specifying the owner of the repo
         repo - str giving the name of the repo
         params - list of parameter tuples
         auth - authorization information
+        rescan - if True, the state file is ignored and all of the repo's
+                    pull requests are checked again
     Returns:
-        the list of SHA-1 values, produces the output files
+        the sorted list of distinct SHA-1 values, produces the output files
     """
-    pulls = get_pull_requests(owner, repo, params, auth)
-    shas = []
-    # We'll use this dictionary to generate JSON and CSV
+    # Pull requests can share commits, e.g. after a rebase or cherry-pick,
+    # so the text file lists each SHA-1 just once
+    shas = set()
+    if rescan:
+        state = {"max_pull_number":0, "pull_commits":{}}
+    else:
+        state = load_state(owner, repo)
+    since = state["max_pull_number"]
+    if since:
+        fstr = "{0}Checking pull requests newer than #{1}\n"
+        write_status(fstr.format(NOTE_LABEL, since))
+    # Merged results of this run and the earlier ones, for the state file
     pull_commits = {}
-    ns1 = ("{0}Checking for defects associated with "
-             "pull requests.\n").format(NOTE_LABEL)
-    ns2 = "{0}This might take a bit of time...\n".format(NOTE_INDENT)
-    sys.stdout.write("{0}{1}".format(ns1, ns2))
-    if VERBOSE:
-        progress = 0
-    for p in pulls:
-        if VERBOSE:
-            if progress // 10 > 0:
-                sys.stdout.write("*")
-            progress += 1
-            if progress == 71:
-                sys.stdout.write("\n")
-                progress = 0
-
-        if is_defect(p, params, auth):
-            # print("#{0}- Head: {1}".format(p["number"], p["head"]["sha"]))
-            # print("#{0}- Base: {1}".format(p["number"], p["base"]["sha"]))
-            commits = get_commits_by_pull(p, params, auth)
-            #shas.append(p["head"]["sha"])
-            shas.extend(commits)
-            pull_commits[p["number"]] = commits
-                         
-
-    if VERBOSE:
-        sys.stdout.write("\n")
-
-    # Generate the text format file
-    with open(''.join(["./", repo, "_pulls.txt"]), 'w') as f:
-            for s in shas:
-                f.write("{}\n".format(s))
-
-    # Generate the CSV
-    with open(''.join(["./", repo, "_pulls.csv"]), 'w', newline='') as f:
-        writer = csv.writer( f
+    # Newest pull request seen, defect or not, where the next run starts
+    newest = {"number":since}
+    # GraphQL needs authentication, without it use the REST api
+    if auth is not None:
+        defects = get_defect_commits_graphql(owner, repo, auth, since, newest)
+    else:
+        defects = get_defect_commits(owner, repo, params, auth, since, newest)
+    defects = show_progress(defects)
+
+    # Each pull request's commits are written to the CSV and JSON files
+    # as they arrive, followed by those found by earlier runs. They go to
+    # temporary files first, so that a failed run leaves the previous
+    # output in place.
+    csv_path = ''.join(["./", repo, "_pulls.csv"])
+    json_path = ''.join(["./", repo, "_pulls.json"])
+    with open(csv_path + ".tmp", 'w', newline='') as csv_f, \
+         open(json_path + ".tmp", 'wb') as json_f:
+        writer = csv.writer( csv_f
                             ,quoting=csv.QUOTE_MINIMAL
                             ,lineterminator=os.linesep
                            )
         writer.writerow(["Pull", "Commit-SHA", "Owner", "Repo"])
-        for p in pull_commits:
-            for s in pull_commits[p]:
-                writer.writerow([p,s, owner, repo])
-
-    # Generate the JSON
-    # WARNING: We're adding data to the commit dictionary for the JSON
-    #          output. After this, it will no longer be suited for row
-    #          based output
-    json_out = {
-                 "owner":owner
-                ,"repo":repo
-                ,"pull_requests":pull_commits
-               }
-    with open(''.join(["./", repo, "_pulls.json"]), 'w') as f:
-        json.dump(json_out, f)
+        # The JSON object is written out piecemeal, the pull requests
+        # member is filled in as we go
+        json_f.write(b''.join([ b'{"owner":'
+                               ,json_bytes(owner)
+                               ,b',"repo":'
+                               ,json_bytes(repo)
+                               ,b',"pull_requests":{'
+                              ]))
+        sep = b""
+        for num, commits in itertools.chain(defects,
+                                            state["pull_commits"].items()):
+            pull_commits[num] = commits
+            shas.update(commits)
+            writer.writerows((num, s, owner, repo) for s in commits)
+            json_f.write(b''.join([ sep
+                                   ,json_bytes(str(num))
+                                   ,b":"
+                                   ,json_bytes(commits)
+                                  ]))
+            sep = b","
+        json_f.write(b"}}")
+    os.replace(csv_path + ".tmp", csv_path)
+    os.replace(json_path + ".tmp", json_path)
 
+    # Generate the text format file
+    shas = sorted(shas)
+    with open(''.join(["./", repo, "_pulls.txt"]), 'w') as f:
+        if shas:
+            f.write("\n".join(shas) + "\n")
 
-    
+    save_state(owner, repo, newest["number"], pull_commits)
     return shas
 
 